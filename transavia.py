@@ -1,35 +1,35 @@
 """Script to check for Transavia flights"""
-from collections import namedtuple
-import calendar
+import asyncio
+from dataclasses import dataclass
 import datetime
+from functools import lru_cache
+from itertools import chain
+import math
+from operator import attrgetter
 import os
 import re
 import sys
-import time
+from urllib.parse import urlencode
 
-from dateutil.relativedelta import relativedelta
-import requests
-import requests_cache
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+import orjson
 
 load_dotenv()
 
 API_KEY = os.getenv("TRANSAVIA_KEY")
-API_URL = (
-    "https://api.transavia.com/v1/flightoffers"
-    "?origin={origin}"
-    "&destination={destination}"
-    "&origindeparturedate={start_date}"
-    "&destinationdeparturedate={end_date}"
-    "&origindeparturetime={start_timerange}"
-    "&destinationdeparturetime={end_timerange}"
-    "&daysatdestination={days_stay}"
-    "&directflight=true"
-    "&adults=1"
-    "&limit=100"
-    "&orderby=Price"
-)
+API_URL = "https://api.transavia.com/v1/flightoffers?"
+API_FIXED_PARAMS = {
+    "directflight": "true",
+    "adults": 1,
+    "limit": 100,
+    "orderby": "Price",
+}
 REFRESH_CACHE = 3600
+MAX_CONCURRENT_REQUESTS = 10
+MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 DEBUG = bool(os.getenv("DEBUG", False))
 
 NOW = datetime.datetime.now()
@@ -39,84 +39,146 @@ NUM_MONTHS_TO_CHECK = 4
 DEFAULT_SORT = "price"
 DEFAULT_TIMERANGE = "0800-2200"
 DEFAULT_MAX_PRICE = 250
+DEFAULT_MAX_RATE = 5  # requests per second
 
-Record = namedtuple("Record", "leave goback price link")
+_TIMERANGE_RE = re.compile(r"^\d{4}-\d{4}$")
+_DAY_ABBR = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
 
-if DEBUG:
-    # cache when developing
-    requests_cache.install_cache(
-        "cache", backend="sqlite", expire_after=REFRESH_CACHE)
 
-
-def gen_months():
-    """Month generator starting with current month.
-    Format: YYYYMM"""
-    i = 1  # start with next month
-    while True:
-        month = NOW + relativedelta(months=+i)
-        yield month.strftime("%Y%m")
-        i += 1
+@dataclass(slots=True, frozen=True)
+class Record:
+    leave: str
+    goback: str
+    price: int
+    link: str
 
 
-def query_api(params):
-    """Query Transavia API with API_KEY in headers.
-    Url is build up from params dict passed in.
+def next_months(num_months, now=NOW):
+    """List of the num_months months following now's month.
+    Format: YYYYMM"""
+    months = []
+    for i in range(1, num_months + 1):  # start with next month
+        month = now.month + i
+        year = now.year + (month - 1) // 12
+        months.append(f"{year:04d}{(month - 1) % 12 + 1:02d}")
+    return months
+
+
+async def fetch(session, params, limiter, semaphore,
+                retries=MAX_RETRIES, report_errors=True):
+    """Query Transavia API with API_KEY in headers, retrying 429/5xx.
+    Returns the decoded json response, or None on a bad response.
     API docs: https://developer.transavia.com"""
     headers = {"apikey": API_KEY}
-    # no f-string because using 3.5 on server where this runs
-    url = API_URL.format(**params)
-    resp = requests.get(url, headers=headers)
-
-    if not resp.ok:
-        print("Bad response:", resp)
-        return []
-
-    data = resp.json()
-
-    flight_combo_seen = set()
+    url = API_URL + urlencode(dict(params, **API_FIXED_PARAMS))
+    for attempt in range(retries):
+        async with semaphore, limiter:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status not in RETRY_STATUSES:
+                    if not resp.ok:
+                        if report_errors:
+                            print("Bad response:", resp)
+                        return None
+                    return orjson.loads(await resp.read())
+                status = resp.status
+        if attempt < retries - 1:
+            await asyncio.sleep(2 ** attempt)
+
+    if report_errors:
+        print("Bad response after {} attempts:".format(retries), status)
+    return None
+
+
+async def query_months(url_params, num_months=NUM_MONTHS_TO_CHECK,
+                       max_rate=DEFAULT_MAX_RATE,
+                       max_price=DEFAULT_MAX_PRICE):
+    """Query the API for the coming num_months in one date range request,
+    falling back to concurrent per-month requests if that one is rejected
+    or capped before max_price. Responses are cached in sqlite"""
+    # bucket of at least 1 so fractional rates work and integer ones burst
+    capacity = max(max_rate, 1)
+    limiter = AsyncLimiter(capacity, capacity / max_rate)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    cache = SQLiteBackend(
+        "cache", expire_after=REFRESH_CACHE, cache_control=True)
+    months = next_months(num_months)
+    async with CachedSession(cache=cache) as session:
+        date_range = f"{months[0]}-{months[-1]}"
+        data = await fetch(
+            session,
+            dict(url_params, origindeparturedate=date_range,
+                 destinationdeparturedate=date_range),
+            limiter, semaphore, retries=1, report_errors=False)
+        if data is not None:
+            offers = data["flightOffer"]
+            capped = len(offers) >= API_FIXED_PARAMS["limit"]
+            # offers are ordered by price, so a capped result that already
+            # went over budget can't have cut off anything we'd keep
+            if not capped or _get_price(offers[-1]) > max_price:
+                return [data]
+
+        tasks = [
+            fetch(session,
+                  dict(url_params, origindeparturedate=month,
+                       destinationdeparturedate=month),
+                  limiter, semaphore)
+            for month in months
+        ]
+        return await asyncio.gather(*tasks)
+
+
+def parse_offers(data, seen, max_price=DEFAULT_MAX_PRICE):
+    """Parse flight offers from a Transavia API response into Records.
+    Offers above max_price are dropped here so they never get stored.
+    Outbound/inbound flight combos already in the seen set are skipped,
+    pass the same set for all responses of a run to dedupe across them"""
+    if not data:
+        return
 
     for offer in data["flightOffer"]:
-        key = (offer["outboundFlight"]["id"], offer["inboundFlight"]["id"])
-        if key in flight_combo_seen:
+        outbound = offer["outboundFlight"]
+        inbound = offer["inboundFlight"]
+
+        key = (outbound["id"], inbound["id"])
+        if key in seen:
             continue
         else:
-            flight_combo_seen.add(key)
-
-        leave = offer["outboundFlight"]["departureDateTime"][:-3]
-        goback = offer["inboundFlight"]["departureDateTime"][:-3]
+            seen.add(key)
 
-        leave_day = _get_dayname(leave)
-        goback_day = _get_dayname(goback)
+        price = _get_price(offer)
+        if price > max_price:
+            continue
 
-        price = offer["pricingInfoSum"]["totalPriceAllPassengers"]
-        link = offer["deeplink"]["href"]
+        leave = outbound["departureDateTime"][:-3]
+        goback = inbound["departureDateTime"][:-3]
 
         yield Record(
-            leave=leave + leave_day,
-            goback=goback + goback_day,
+            leave=leave + _get_dayname(leave),
+            goback=goback + _get_dayname(goback),
             price=price,
-            link=link
+            link=offer["deeplink"]["href"]
         )
 
 
+def _get_price(offer):
+    """Get total price of a flight offer as int"""
+    return int(offer["pricingInfoSum"]["totalPriceAllPassengers"])
+
+
+@lru_cache(maxsize=4096)
 def _get_dayname(day):
-    """Get weekday (first 3 chars) from date string"""
+    """Get weekday (first 3 chars) from date string,
+    memoized as the same timestamps recur across offers"""
     try:
         dt = datetime.datetime.strptime(day, "%Y-%m-%dT%H:%M")
     except ValueError:
         return ""
-    weekday = dt.weekday()
-    day_name = calendar.day_name[weekday]
-    return " ({})".format(day_name[:3])
+    return " ({})".format(_DAY_ABBR[dt.weekday()])
 
 
-def gen_output(results, sort_by=DEFAULT_SORT, max_price=DEFAULT_MAX_PRICE):
-    """Builds an html section of the output report"""
-    try:
-        results.sort(key=lambda r: getattr(r, sort_by))
-    except AttributeError:
-        raise
-
+def gen_output(results, sort_by=DEFAULT_SORT):
+    """Builds an html section of the output report,
+    results are expected to be sorted by sort_by already"""
     output = []
     output.append("<h2>* Sorted by {}</h2>".format(sort_by))
     output.append("<table>")
@@ -125,18 +187,16 @@ def gen_output(results, sort_by=DEFAULT_SORT, max_price=DEFAULT_MAX_PRICE):
     fmt = "<tr><th>{}</th><th>{}</th><th>{}</th><th>{}</th></tr>"
     output.append(fmt.format(*cols))
 
-    fmt = (
-        "<tr{0}>"
-        "<td>{1.leave}</td>"
-        "<td>{1.goback}</td>"
-        "<td>{1.price}</td>"
-        "<td><a href='{1.link}' target='_blank'>book</a></td>"
+    rows = (
+        "<tr>"
+        f"<td>{rec.leave}</td>"
+        f"<td>{rec.goback}</td>"
+        f"<td>{rec.price}</td>"
+        f"<td><a href='{rec.link}' target='_blank'>book</a></td>"
         "</tr>"
+        for rec in results
     )
-    for rec in results:
-        style = " style='color: b2beb5;'" if int(rec.price) > max_price else ""
-        row = fmt.format(style, rec)
-        output.append(row)
+    output.extend(rows)
 
     output.append("</table>")
     return output
@@ -146,11 +206,15 @@ if __name__ == "__main__":
     script = sys.argv.pop(0)
     args = sys.argv
 
+    if not API_KEY:
+        sys.exit("Please set TRANSAVIA_KEY in your environment or .env file")
+
     if len(args) < 3:
         usage = (
             "Usage: {} from_airport to_airport days_stay ".format(script),
             "(timerange, default={}) ".format(DEFAULT_TIMERANGE),
-            "(maxprice, default={})".format(DEFAULT_MAX_PRICE),
+            "(maxprice, default={}) ".format(DEFAULT_MAX_PRICE),
+            "(maxrate, default={})".format(DEFAULT_MAX_RATE),
         )
         print("".join(usage))
         print(
@@ -172,7 +236,7 @@ if __name__ == "__main__":
 
         if len(args) > 3:
             timerange = args[3]
-            if not re.match(r"\d{4}-\d{4}", timerange):
+            if not _TIMERANGE_RE.match(timerange):
                 sys.exit(
                     "Please provide a timerange with format like {}".format(
                         DEFAULT_TIMERANGE
@@ -190,25 +254,31 @@ if __name__ == "__main__":
         else:
             max_price = DEFAULT_MAX_PRICE
 
-    months = gen_months()
+        if len(args) > 5:
+            try:
+                max_rate = float(args[5])
+                if not (math.isfinite(max_rate) and max_rate > 0):
+                    raise ValueError
+            except ValueError:
+                print("Please provide a numeric max rate (requests/sec) above 0")
+                sys.exit(1)
+        else:
+            max_rate = DEFAULT_MAX_RATE
 
     keys = (
-        "origin destination start_date end_date start_timerange "
-        "end_timerange days_stay"
+        "origin destination origindeparturetime destinationdeparturetime "
+        "daysatdestination"
     ).split()
-    values = (origin, destination, 0, 0, timerange, timerange, duration)
+    values = (origin, destination, timerange, timerange, duration)
     url_params = dict(zip(keys, values))
 
-    results = []
-    for _ in range(NUM_MONTHS_TO_CHECK):
-        next_month = next(months)
-
-        url_params["start_date"] = next_month
-        url_params["end_date"] = next_month
-
-        results += list(query_api(url_params))
-
-        time.sleep(2)
+    responses = asyncio.run(query_months(
+        url_params, max_rate=max_rate, max_price=max_price))
+    flight_combo_seen = set()
+    results = list(chain.from_iterable(
+        parse_offers(data, flight_combo_seen, max_price)
+        for data in responses
+    ))
 
     subject = "Flights {} - {} ({} days stay)".format(
         origin, destination, duration)
@@ -217,7 +287,8 @@ if __name__ == "__main__":
 
     sort_orders = ("price", "leave")
     for sort in sort_orders:
-        output = "\n".join(gen_output(results, sort_by=sort))
+        sorted_results = sorted(results, key=attrgetter(sort))
+        output = "\n".join(gen_output(sorted_results, sort_by=sort))
         content.append(output)
 
     if DEBUG: